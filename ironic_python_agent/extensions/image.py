@@ -19,7 +19,9 @@ import shlex
 import shutil
 import stat
 import tempfile
+import time
 
+from ironic_lib import disk_utils
 from ironic_lib import utils as ilib_utils
 from oslo_concurrency import processutils
 from oslo_config import cfg
@@ -37,7 +39,7 @@ CONF = cfg.CONF
 
 BIND_MOUNTS = ('/dev', '/proc', '/run')
 
-BOOTLOADERS_EFI = [
+BOOTLOADERS_EFI = frozenset([
     'bootia32.efi',
     'bootx64.efi',
     'bootia64.efi',
@@ -48,15 +50,50 @@ BOOTLOADERS_EFI = [
     'bootriscv128.efi',
     'grubaa64.efi',
     'winload.efi'
-]
+])
 
+# The directory walk in _get_efi_bootloaders is done with bytes paths, this
+# avoids decoding the name of every entry on the efi partition.
+_BOOTLOADERS_EFI_BYTES = frozenset(name.encode() for name in BOOTLOADERS_EFI)
 
-def _rescan_device(device):
+# Regex used to identify the existing entries in the output of efibootmgr.
+# Example: "Boot0004* ironic1  HD(1,GPT,...)/File(\EFI\BOOT\BOOTX64.EFI)"
+_EFI_ENTRY_RE = re.compile(r'^Boot([0-9a-fA-F]+)\*? (.*)$', re.MULTILINE)
+
+# Regex used to get the partition number following the device name, NVMe
+# devices get a partitioning scheme that is different from traditional block
+# devices like SCSI/SATA. Example: "/dev/sda1" or "/dev/nvme0n1p1"
+_PARTITION_NUMBER_RE = re.compile(r'p?(\d+)$')
+
+# The time of the last successful rescan of each device, as returned by
+# time.monotonic(), see _rescan_device.
+_LAST_RESCAN = {}
+
+# A device rescanned less than this many seconds ago does not need to be
+# rescanned again unless the rescan is forced.
+_RESCAN_INTERVAL = 5
+
+
+def _rescan_device(device, force=True):
     """Force the device to be rescanned
 
+    Only the rescans done here are recorded, the partition table may also be
+    rewritten elsewhere (e.g. when standby writes an image), so the rescan
+    must only be skipped right after another rescan done by this module.
+
     :param device: device upon which to rescan and update
                    kernel partition records.
+    :param force: if False, do nothing if the device has already been
+                  rescanned less than _RESCAN_INTERVAL seconds ago.
     """
+    last_rescan = _LAST_RESCAN.get(device)
+    if (not force and last_rescan is not None
+            and time.monotonic() - last_rescan < _RESCAN_INTERVAL):
+        LOG.debug('Device %s has just been rescanned, not rescanning it '
+                  'again', device)
+        return
+
+    _LAST_RESCAN.pop(device, None)
     try:
         utils.execute('partx', '-u', device, attempts=3,
                       delay_on_retry=True)
@@ -64,6 +101,8 @@ def _rescan_device(device):
     except processutils.ProcessExecutionError:
         LOG.warning("Couldn't re-read the partition table "
                     "on device %s", device)
+    else:
+        _LAST_RESCAN[device] = time.monotonic()
 
 
 def _get_partition(device, uuid):
@@ -72,7 +111,7 @@ def _get_partition(device, uuid):
               {'dev': device, 'uuid': uuid})
 
     try:
-        _rescan_device(device)
+        _rescan_device(device, force=False)
         lsblk = utils.execute(
             'lsblk', '-PbioKNAME,UUID,PARTUUID,TYPE,LABEL', device)
         report = lsblk[0]
@@ -155,6 +194,28 @@ def _get_partition(device, uuid):
         raise errors.CommandExecutionError(error_msg)
 
 
+def _get_efi_partition(device, efi_system_part_uuid=None):
+    """Find the number of the efi partition of a given device.
+
+    :param device: the device holding the efi partition.
+    :param efi_system_part_uuid: efi partition uuid, used when the efi
+                                 partition cannot be found in the partition
+                                 table.
+    :return: the number of the efi partition or None.
+    """
+    # Trust the contents on the disk in the event of a whole disk image.
+    efi_partition = utils.get_efi_part_on_device(device)
+    if not efi_partition and efi_system_part_uuid:
+        # _get_partition returns <device>+<partition> and we only need the
+        # partition number
+        partition = _get_partition(device, uuid=efi_system_part_uuid)
+        if partition.startswith(device):
+            match = _PARTITION_NUMBER_RE.match(partition, len(device))
+            if match:
+                efi_partition = int(match.group(1))
+    return efi_partition
+
+
 def _has_dracut(root):
     try:
         utils.execute('chroot %(path)s /bin/sh -c '
@@ -230,20 +291,57 @@ def _get_efi_bootloaders(location):
     # Let's find all files with .efi or .EFI extension
     LOG.debug('Looking for all efi files on %s', location)
     valid_bootloaders = []
-    for root, dirs, files in os.walk(location):
-        efi_files = [f for f in files if f.lower() in BOOTLOADERS_EFI]
-        LOG.debug('efi files found in %(location)s : %(efi_files)s',
-                  {'location': location, 'efi_files': str(efi_files)})
-        for name in efi_files:
-            efi_f = os.path.join(root, name)
-            LOG.debug('Checking if %s is executable', efi_f)
-            if os.access(efi_f, os.X_OK):
-                v_bl = efi_f.split(location)[-1][1:]
-                LOG.debug('%s is a valid bootloader', v_bl)
-                valid_bootloaders.append(v_bl)
+    # NOTE: os.walk is built on os.scandir as well, but it keeps the names
+    # of all the files of every directory, here the files are checked while
+    # the directory is listed and only the subdirectories are kept. Only the
+    # paths of the matching files are decoded.
+    directories = [os.fsencode(location)]
+    while directories:
+        directory = directories.pop()
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    if entry.name.lower() not in _BOOTLOADERS_EFI_BYTES:
+                        continue
+                    efi_f = os.fsdecode(entry.path)
+                    LOG.debug('efi file found: %s', efi_f)
+                    if os.access(efi_f, os.X_OK):
+                        v_bl = os.path.relpath(efi_f, location)
+                        LOG.debug('%s is a valid bootloader', v_bl)
+                        valid_bootloaders.append(v_bl)
+        except OSError as e:
+            # NOTE: like os.walk, skip the directories that cannot be listed,
+            # a damaged efi partition must not prevent using the bootloaders
+            # found elsewhere on it.
+            LOG.warning('Could not list the directory %(dir)s on the efi '
+                        'partition: %(err)s',
+                        {'dir': os.fsdecode(directory), 'err': e})
+            continue
+        # NOTE: the order of the bootloaders decides their ironicN labels and
+        # their position in BootOrder, push the subdirectories in reverse so
+        # that they are visited in the same top-down order as os.walk.
+        directories.extend(reversed(subdirs))
     return valid_bootloaders
 
 
+def _get_efi_boot_entries():
+    """Get the boot entries currently registered in the nvram.
+
+    :return: a list of (boot number, label) tuples.
+    """
+    stdout, _ = utils.execute('efibootmgr', '-v')
+    entries = []
+    for match in _EFI_ENTRY_RE.finditer(stdout):
+        # In verbose mode the label is followed by the device path.
+        label = match.group(2).split('\t', 1)[0]
+        entries.append((match.group(1), label.strip()))
+    return entries
+
+
 def _run_efibootmgr(valid_efi_bootloaders, device, efi_partition):
     """Executes efibootmgr and removes duplicate entries.
 
@@ -254,31 +352,45 @@ def _run_efibootmgr(valid_efi_bootloaders, device, efi_partition):
 
     # Before updating let's get information about the bootorder
     LOG.debug("Getting information about boot order")
-    utils.execute('efibootmgr')
-    # NOTE(iurygregory): regex used to identify the Warning in the stderr after
-    # we add the new entry. Example:
-    # "efibootmgr: ** Warning ** : Boot0004 has same label ironic"
-    duplicated_label = re.compile(r'^.*:\s\*\*.*\*\*\s:\s.*'
-                                  r'Boot([0-9a-f-A-F]+)\s.*$')
-    label_id = 1
-    for v_bl in valid_efi_bootloaders:
-        v_efi_bl_path = '\\' + v_bl.replace('/', '\\')
+    # Parse the existing entries only once, so looking up the duplicates of
+    # every label we add does not require scanning the whole output again.
+    existing_entries = {}
+    for boot_num, existing_label in _get_efi_boot_entries():
+        existing_entries.setdefault(existing_label, []).append(boot_num)
+
+    new_entries = [
+        ('ironic' + str(label_id), '\\' + v_bl.replace('/', '\\'))
+        for label_id, v_bl in enumerate(valid_efi_bootloaders, start=1)]
+
+    commands = []
+    # Remove all the entries using one of our labels before adding any new
+    # entry, every stale entry is only removed once.
+    duplicated_boot_nums = set()
+    for label, _ in new_entries:
+        duplicated_boot_nums.update(existing_entries.get(label, ()))
+    for boot_num in sorted(duplicated_boot_nums):
+        LOG.debug("Found bootnum %s matching label", boot_num)
+        commands.append(['efibootmgr', '-b', boot_num, '-B'])
+
+    # NOTE: the entries are added one at a time on purpose, efibootmgr picks
+    # the first free boot number and rewrites BootOrder for every new entry,
+    # so concurrent invocations would race with each other.
+    for label, v_efi_bl_path in new_entries:
         # Update the nvram using efibootmgr
         # https://linux.die.net/man/8/efibootmgr
-        label = 'ironic' + str(label_id)
         LOG.debug("Adding loader %(path)s on partition %(part)s of device "
                   " %(dev)s", {'path': v_efi_bl_path, 'part': efi_partition,
                                'dev': device})
-        cmd = utils.execute('efibootmgr', '-c', '-d', device,
-                            '-p', efi_partition, '-w', '-L', label,
-                            '-l', v_efi_bl_path)
-        for line in cmd[1].split('\n'):
-            match = duplicated_label.match(line)
-            if match:
-                boot_num = match.group(1)
-                LOG.debug("Found bootnum %s matching label", boot_num)
-                utils.execute('efibootmgr', '-b', boot_num, '-B')
-        label_id += 1
+        commands.append(['efibootmgr', '-c', '-d', device,
+                         '-p', str(efi_partition), '-w', '-L', label,
+                         '-l', v_efi_bl_path])
+
+    if commands:
+        # Run all the efibootmgr commands from a single shell instead of
+        # spawning a process per command, stopping at the first failure.
+        script = '\n'.join(' '.join(shlex.quote(arg) for arg in command)
+                           for command in commands)
+        utils.execute('sh', '-e', '-c', script)
 
 
 def _manage_uefi(device, efi_system_part_uuid=None):
@@ -299,22 +411,14 @@ def _manage_uefi(device, efi_system_part_uuid=None):
 
     try:
         # Force UEFI to rescan the device.
+        # NOTE: always force this rescan, the partition table may have been
+        # rewritten without going through _rescan_device.
         _rescan_device(device)
 
-        local_path = tempfile.mkdtemp()
-        # Trust the contents on the disk in the event of a whole disk image.
-        efi_partition = utils.get_efi_part_on_device(device)
-        if not efi_partition and efi_system_part_uuid:
-            # _get_partition returns <device>+<partition> and we only need the
-            # partition number
-            partition = _get_partition(device, uuid=efi_system_part_uuid)
-            try:
-                efi_partition = int(partition.replace(device, ""))
-            except ValueError:
-                # NVMe Devices get a partitioning scheme that is different from
-                # traditional block devices like SCSI/SATA
-                efi_partition = int(partition.replace(device + 'p', ""))
-
+        # Nothing else uses the mount point, mount the efi partition directly
+        # on the temporary directory.
+        efi_partition_mount_point = tempfile.mkdtemp()
+        efi_partition = _get_efi_partition(device, efi_system_part_uuid)
         if not efi_partition:
             # NOTE(dtantsur): we cannot have a valid EFI deployment without an
             # EFI partition at all. This code path is easily hit when using an
@@ -326,19 +430,15 @@ def _manage_uefi(device, efi_system_part_uuid=None):
                 "(which is often the case for whole disk images). "
                 "Are you using a UEFI-compatible image?" % device)
 
-        efi_partition_mount_point = os.path.join(local_path, "boot/efi")
-        if not os.path.exists(efi_partition_mount_point):
-            os.makedirs(efi_partition_mount_point)
-
         # The mount needs the device with the partition, in case the
         # device ends with a digit we add a `p` and the partition number we
         # found, otherwise we just join the device and the partition number
-        if device[-1].isdigit():
-            efi_device_part = '{}p{}'.format(device, efi_partition)
-            utils.execute('mount', efi_device_part, efi_partition_mount_point)
-        else:
-            efi_device_part = '{}{}'.format(device, efi_partition)
-            utils.execute('mount', efi_device_part, efi_partition_mount_point)
+        efi_device_part = disk_utils.partition_index_to_path(
+            device, int(efi_partition))
+        # NOTE: the efi partition is only read, mounting it read-only avoids
+        # any metadata update being written back to it.
+        utils.execute('mount', '-o', 'ro', efi_device_part,
+                      efi_partition_mount_point)
         efi_mounted = True
 
         valid_efi_bootloaders = _get_efi_bootloaders(efi_partition_mount_point)
@@ -357,7 +457,6 @@ def _manage_uefi(device, efi_system_part_uuid=None):
         raise errors.CommandExecutionError(error_msg)
     finally:
         LOG.debug('Executing _manage_uefi clean-up.')
-        umount_warn_msg = "Unable to umount %(local_path)s. Error: %(error)s"
 
         try:
             if efi_mounted:
@@ -370,15 +469,11 @@ def _manage_uefi(device, efi_system_part_uuid=None):
             raise errors.CommandExecutionError(error_msg)
 
         else:
-            # If umounting the binds succeed then we can try to delete it
-            try:
-                utils.execute('sync')
-            except processutils.ProcessExecutionError as e:
-                LOG.warning(umount_warn_msg, {'path': local_path, 'error': e})
-            else:
-                # After everything is umounted we can then remove the
-                # temporary directory
-                shutil.rmtree(local_path)
+            # NOTE: nothing is ever written to the efi partition here, and
+            # umount flushes the filesystem anyway, so there is no need for
+            # a system-wide sync before removing the temporary directory.
+            if efi_partition_mount_point:
+                os.rmdir(efi_partition_mount_point)
 
 
 # TODO(rg): handle PreP boot parts relocation as well
@@ -13,9 +13,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import errno
 import os
 import shutil
 import tempfile
+import time
 from unittest import mock
 
 from ironic_lib import utils as ilib_utils
@@ -32,6 +34,7 @@ from ironic_python_agent import utils
 @mock.patch.object(utils, 'execute', autospec=True)
 @mock.patch.object(tempfile, 'mkdtemp', lambda *_: '/tmp/fake-dir')
 @mock.patch.object(shutil, 'rmtree', lambda *_: None)
+@mock.patch.object(os, 'rmdir', lambda *_: None)
 class TestImageExtension(base.IronicAgentTest):
 
     def setUp(self):
@@ -45,6 +48,7 @@ class TestImageExtension(base.IronicAgentTest):
         self.fake_efi_system_part_uuid = '45AB-2312'
         self.fake_prep_boot_part_uuid = '76937797-3253-8843-999999999999'
         self.fake_dir = '/tmp/fake-dir'
+        image._LAST_RESCAN.clear()
 
     @mock.patch.object(image, '_install_grub2', autospec=True)
     def test__install_bootloader_bios(self, mock_grub2,
@@ -210,13 +214,11 @@ class TestImageExtension(base.IronicAgentTest):
         self.assertFalse(mock_grub2.called)
 
     @mock.patch.object(hardware, 'is_md_device', lambda *_: False)
-    @mock.patch.object(os.path, 'exists', lambda *_: False)
     @mock.patch.object(image, '_get_efi_bootloaders', autospec=True)
     @mock.patch.object(image, '_get_partition', autospec=True)
     @mock.patch.object(utils, 'get_efi_part_on_device', autospec=False)
-    @mock.patch.object(os, 'makedirs', autospec=True)
     def test__uefi_bootloader_given_partition(
-            self, mkdir_mock, mock_utils_efi_part, mock_partition,
+            self, mock_utils_efi_part, mock_partition,
             mock_efi_bl, mock_execute, mock_dispatch):
         mock_dispatch.side_effect = [
             self.fake_dev, hardware.BootInfo(current_boot_mode='uefi')
@@ -234,16 +236,14 @@ class TestImageExtension(base.IronicAgentTest):
                     mock.call('partx', '-u', '/dev/fake', attempts=3,
                               delay_on_retry=True),
                     mock.call('udevadm', 'settle'),
-                    mock.call('mount', self.fake_efi_system_part,
-                              self.fake_dir + '/boot/efi'),
-                    mock.call('efibootmgr'),
-                    mock.call('efibootmgr', '-c', '-d', self.fake_dev,
-                              '-p', '1', '-w',
-                              '-L', 'ironic1', '-l',
-                              '\\EFI\\BOOT\\BOOTX64.EFI'),
-                    mock.call('umount', self.fake_dir + '/boot/efi',
-                              attempts=3, delay_on_retry=True),
-                    mock.call('sync')]
+                    mock.call('mount', '-o', 'ro', self.fake_efi_system_part,
+                              self.fake_dir),
+                    mock.call('efibootmgr', '-v'),
+                    mock.call('sh', '-e', '-c',
+                              'efibootmgr -c -d /dev/fake -p 1 -w -L ironic1 '
+                              "-l '\\EFI\\BOOT\\BOOTX64.EFI'"),
+                    mock.call('umount', self.fake_dir,
+                              attempts=3, delay_on_retry=True)]
 
         self.agent_extension.install_bootloader(
             root_uuid=self.fake_root_uuid,
@@ -251,20 +251,17 @@ class TestImageExtension(base.IronicAgentTest):
 
         mock_dispatch.assert_any_call('get_os_install_device')
         mock_dispatch.assert_any_call('get_boot_info')
-        mkdir_mock.assert_called_once_with(self.fake_dir + '/boot/efi')
-        mock_efi_bl.assert_called_once_with(self.fake_dir + '/boot/efi')
+        mock_efi_bl.assert_called_once_with(self.fake_dir)
         mock_execute.assert_has_calls(expected)
         mock_utils_efi_part.assert_called_once_with(self.fake_dev)
-        self.assertEqual(8, mock_execute.call_count)
+        self.assertEqual(7, mock_execute.call_count)
 
     @mock.patch.object(hardware, 'is_md_device', lambda *_: False)
-    @mock.patch.object(os.path, 'exists', lambda *_: False)
     @mock.patch.object(image, '_get_efi_bootloaders', autospec=True)
     @mock.patch.object(image, '_get_partition', autospec=True)
     @mock.patch.object(utils, 'get_efi_part_on_device', autospec=True)
-    @mock.patch.object(os, 'makedirs', autospec=True)
     def test__uefi_bootloader_find_partition(
-            self, mkdir_mock, mock_utils_efi_part, mock_partition,
+            self, mock_utils_efi_part, mock_partition,
             mock_efi_bl, mock_execute, mock_dispatch):
         mock_dispatch.side_effect = [
             self.fake_dev, hardware.BootInfo(current_boot_mode='uefi')
@@ -281,16 +278,14 @@ class TestImageExtension(base.IronicAgentTest):
                     mock.call('partx', '-u', '/dev/fake', attempts=3,
                               delay_on_retry=True),
                     mock.call('udevadm', 'settle'),
-                    mock.call('mount', self.fake_efi_system_part,
-                              self.fake_dir + '/boot/efi'),
-                    mock.call('efibootmgr'),
-                    mock.call('efibootmgr', '-c', '-d', self.fake_dev,
-                              '-p', '1', '-w',
-                              '-L', 'ironic1', '-l',
-                              '\\EFI\\BOOT\\BOOTX64.EFI'),
-                    mock.call('umount', self.fake_dir + '/boot/efi',
-                              attempts=3, delay_on_retry=True),
-                    mock.call('sync')]
+                    mock.call('mount', '-o', 'ro', self.fake_efi_system_part,
+                              self.fake_dir),
+                    mock.call('efibootmgr', '-v'),
+                    mock.call('sh', '-e', '-c',
+                              'efibootmgr -c -d /dev/fake -p 1 -w -L ironic1 '
+                              "-l '\\EFI\\BOOT\\BOOTX64.EFI'"),
+                    mock.call('umount', self.fake_dir,
+                              attempts=3, delay_on_retry=True)]
 
         self.agent_extension.install_bootloader(
             root_uuid=self.fake_root_uuid,
@@ -298,20 +293,17 @@ class TestImageExtension(base.IronicAgentTest):
 
         mock_dispatch.assert_any_call('get_os_install_device')
         mock_dispatch.assert_any_call('get_boot_info')
-        mkdir_mock.assert_called_once_with(self.fake_dir + '/boot/efi')
-        mock_efi_bl.assert_called_once_with(self.fake_dir + '/boot/efi')
+        mock_efi_bl.assert_called_once_with(self.fake_dir)
         mock_execute.assert_has_calls(expected)
         mock_utils_efi_part.assert_called_once_with(self.fake_dev)
-        self.assertEqual(8, mock_execute.call_count)
+        self.assertEqual(7, mock_execute.call_count)
 
     @mock.patch.object(hardware, 'is_md_device', lambda *_: False)
-    @mock.patch.object(os.path, 'exists', lambda *_: False)
     @mock.patch.object(image, '_get_efi_bootloaders', autospec=True)
     @mock.patch.object(image, '_get_partition', autospec=True)
     @mock.patch.object(utils, 'get_efi_part_on_device', autospec=True)
-    @mock.patch.object(os, 'makedirs', autospec=True)
     def test__uefi_bootloader_with_entry_removal(
-            self, mkdir_mock, mock_utils_efi_part, mock_partition,
+            self, mock_utils_efi_part, mock_partition,
             mock_efi_bl, mock_execute, mock_dispatch):
         mock_dispatch.side_effect = [
             self.fake_dev, hardware.BootInfo(current_boot_mode='uefi')
@@ -319,13 +311,18 @@ class TestImageExtension(base.IronicAgentTest):
         mock_partition.return_value = self.fake_dev
         mock_utils_efi_part.return_value = '1'
         mock_efi_bl.return_value = ['EFI/BOOT/BOOTX64.EFI']
-        stdeer_msg = """
-efibootmgr: ** Warning ** : Boot0004 has same label ironic1\n
-efibootmgr: ** Warning ** : Boot0005 has same label ironic1\n
+        stdout_msg = """
+BootCurrent: 0001
+Timeout: 0 seconds
+BootOrder: 0000,0004,0005,0001
+Boot0000* ironic2\tHD(1,GPT,...)/File(\\WINDOWS\\system32\\winload.efi)
+Boot0001* Network\tPciRoot(0x0)/Pci(0x1,0x1)/MAC(aabbccddeeff,0)
+Boot0004* ironic1\tHD(1,GPT,...)/File(\\EFI\\BOOT\\BOOTX64.EFI)
+Boot0005* ironic1\tHD(1,GPT,...)/File(\\EFI\\BOOT\\BOOTX64.EFI)
 """
         mock_execute.side_effect = iter([('', ''), ('', ''),
                                          ('', ''), ('', ''),
-                                         ('', ''), ('', stdeer_msg),
+                                         (stdout_msg, ''), ('', ''),
                                          ('', ''), ('', ''),
                                          ('', ''), ('', '')])
 
@@ -333,18 +330,16 @@ efibootmgr: ** Warning ** : Boot0005 has same label ironic1\n
                     mock.call('partx', '-u', '/dev/fake', attempts=3,
                               delay_on_retry=True),
                     mock.call('udevadm', 'settle'),
-                    mock.call('mount', self.fake_efi_system_part,
-                              self.fake_dir + '/boot/efi'),
-                    mock.call('efibootmgr'),
-                    mock.call('efibootmgr', '-c', '-d', self.fake_dev,
-                              '-p', '1', '-w',
-                              '-L', 'ironic1', '-l',
-                              '\\EFI\\BOOT\\BOOTX64.EFI'),
-                    mock.call('efibootmgr', '-b', '0004', '-B'),
-                    mock.call('efibootmgr', '-b', '0005', '-B'),
-                    mock.call('umount', self.fake_dir + '/boot/efi',
-                              attempts=3, delay_on_retry=True),
-                    mock.call('sync')]
+                    mock.call('mount', '-o', 'ro', self.fake_efi_system_part,
+                              self.fake_dir),
+                    mock.call('efibootmgr', '-v'),
+                    mock.call('sh', '-e', '-c',
+                              'efibootmgr -b 0004 -B\n'
+                              'efibootmgr -b 0005 -B\n'
+                              'efibootmgr -c -d /dev/fake -p 1 -w -L ironic1 '
+                              "-l '\\EFI\\BOOT\\BOOTX64.EFI'"),
+                    mock.call('umount', self.fake_dir,
+                              attempts=3, delay_on_retry=True)]
 
         self.agent_extension.install_bootloader(
             root_uuid=self.fake_root_uuid,
@@ -352,20 +347,17 @@ efibootmgr: ** Warning ** : Boot0005 has same label ironic1\n
 
         mock_dispatch.assert_any_call('get_os_install_device')
         mock_dispatch.assert_any_call('get_boot_info')
-        mkdir_mock.assert_called_once_with(self.fake_dir + '/boot/efi')
-        mock_efi_bl.assert_called_once_with(self.fake_dir + '/boot/efi')
+        mock_efi_bl.assert_called_once_with(self.fake_dir)
         mock_execute.assert_has_calls(expected)
         mock_utils_efi_part.assert_called_once_with(self.fake_dev)
-        self.assertEqual(10, mock_execute.call_count)
+        self.assertEqual(7, mock_execute.call_count)
 
     @mock.patch.object(hardware, 'is_md_device', lambda *_: False)
-    @mock.patch.object(os.path, 'exists', lambda *_: False)
     @mock.patch.object(image, '_get_efi_bootloaders', autospec=True)
     @mock.patch.object(image, '_get_partition', autospec=True)
     @mock.patch.object(utils, 'get_efi_part_on_device', autospec=True)
-    @mock.patch.object(os, 'makedirs', autospec=True)
     def test__add_multi_bootloaders(
-            self, mkdir_mock, mock_utils_efi_part, mock_partition,
+            self, mock_utils_efi_part, mock_partition,
             mock_efi_bl, mock_execute, mock_dispatch):
         mock_dispatch.side_effect = [
             self.fake_dev, hardware.BootInfo(current_boot_mode='uefi')
@@ -385,20 +377,16 @@ efibootmgr: ** Warning ** : Boot0005 has same label ironic1\n
                     mock.call('partx', '-u', '/dev/fake', attempts=3,
                               delay_on_retry=True),
                     mock.call('udevadm', 'settle'),
-                    mock.call('mount', self.fake_efi_system_part,
-                              self.fake_dir + '/boot/efi'),
-                    mock.call('efibootmgr'),
-                    mock.call('efibootmgr', '-c', '-d', self.fake_dev,
-                              '-p', '1', '-w',
-                              '-L', 'ironic1', '-l',
-                              '\\EFI\\BOOT\\BOOTX64.EFI'),
-                    mock.call('efibootmgr', '-c', '-d', self.fake_dev,
-                              '-p', '1', '-w',
-                              '-L', 'ironic2', '-l',
-                              '\\WINDOWS\\system32\\winload.efi'),
-                    mock.call('umount', self.fake_dir + '/boot/efi',
-                              attempts=3, delay_on_retry=True),
-                    mock.call('sync')]
+                    mock.call('mount', '-o', 'ro', self.fake_efi_system_part,
+                              self.fake_dir),
+                    mock.call('efibootmgr', '-v'),
+                    mock.call('sh', '-e', '-c',
+                              'efibootmgr -c -d /dev/fake -p 1 -w -L ironic1 '
+                              "-l '\\EFI\\BOOT\\BOOTX64.EFI'\n"
+                              'efibootmgr -c -d /dev/fake -p 1 -w -L ironic2 '
+                              "-l '\\WINDOWS\\system32\\winload.efi'"),
+                    mock.call('umount', self.fake_dir,
+                              attempts=3, delay_on_retry=True)]
 
         self.agent_extension.install_bootloader(
             root_uuid=self.fake_root_uuid,
@@ -406,11 +394,10 @@ efibootmgr: ** Warning ** : Boot0005 has same label ironic1\n
 
         mock_dispatch.assert_any_call('get_os_install_device')
         mock_dispatch.assert_any_call('get_boot_info')
-        mkdir_mock.assert_called_once_with(self.fake_dir + '/boot/efi')
-        mock_efi_bl.assert_called_once_with(self.fake_dir + '/boot/efi')
+        mock_efi_bl.assert_called_once_with(self.fake_dir)
         mock_execute.assert_has_calls(expected)
         mock_utils_efi_part.assert_called_once_with(self.fake_dev)
-        self.assertEqual(9, mock_execute.call_count)
+        self.assertEqual(7, mock_execute.call_count)
 
     @mock.patch.object(image, '_install_grub2', autospec=True)
     def test__install_bootloader_prep(self, mock_grub2,
@@ -2060,12 +2047,10 @@ efibootmgr: ** Warning ** : Boot0005 has same label ironic1\n
         result = image._manage_uefi(self.fake_dev, self.fake_root_uuid)
         self.assertFalse(result)
 
-    @mock.patch.object(os.path, 'exists', lambda *_: False)
     @mock.patch.object(image, '_get_efi_bootloaders', autospec=True)
     @mock.patch.object(image, '_get_partition', autospec=True)
     @mock.patch.object(utils, 'get_efi_part_on_device', autospec=True)
-    @mock.patch.object(os, 'makedirs', autospec=True)
-    def test__manage_uefi(self, mkdir_mock, mock_utils_efi_part,
+    def test__manage_uefi(self, mock_utils_efi_part,
                           mock_get_part_uuid, mock_efi_bl, mock_execute,
                           mock_dispatch):
         mock_utils_efi_part.return_value = '1'
@@ -2081,30 +2066,27 @@ efibootmgr: ** Warning ** : Boot0005 has same label ironic1\n
         expected = [mock.call('partx', '-u', '/dev/fake', attempts=3,
                               delay_on_retry=True),
                     mock.call('udevadm', 'settle'),
-                    mock.call('mount', self.fake_efi_system_part,
-                              self.fake_dir + '/boot/efi'),
-                    mock.call('efibootmgr'),
-                    mock.call('efibootmgr', '-c', '-d', self.fake_dev,
-                              '-p', '1', '-w',
-                              '-L', 'ironic1', '-l',
-                              '\\EFI\\BOOT\\BOOTX64.EFI'),
-                    mock.call('umount', self.fake_dir + '/boot/efi',
-                              attempts=3, delay_on_retry=True),
-                    mock.call('sync')]
-
-        result = image._manage_uefi(self.fake_dev, self.fake_root_uuid)
+                    mock.call('mount', '-o', 'ro', self.fake_efi_system_part,
+                              self.fake_dir),
+                    mock.call('efibootmgr', '-v'),
+                    mock.call('sh', '-e', '-c',
+                              'efibootmgr -c -d /dev/fake -p 1 -w -L ironic1 '
+                              "-l '\\EFI\\BOOT\\BOOTX64.EFI'"),
+                    mock.call('umount', self.fake_dir,
+                              attempts=3, delay_on_retry=True)]
+
+        with mock.patch.object(os, 'rmdir', autospec=True) as mock_rmdir:
+            result = image._manage_uefi(self.fake_dev, self.fake_root_uuid)
         self.assertTrue(result)
-        mkdir_mock.assert_called_once_with(self.fake_dir + '/boot/efi')
-        mock_efi_bl.assert_called_once_with(self.fake_dir + '/boot/efi')
+        mock_efi_bl.assert_called_once_with(self.fake_dir)
         mock_execute.assert_has_calls(expected)
-        self.assertEqual(7, mock_execute.call_count)
+        self.assertEqual(6, mock_execute.call_count)
+        mock_rmdir.assert_called_once_with(self.fake_dir)
 
-    @mock.patch.object(os.path, 'exists', lambda *_: False)
     @mock.patch.object(image, '_get_efi_bootloaders', autospec=True)
     @mock.patch.object(image, '_get_partition', autospec=True)
     @mock.patch.object(utils, 'get_efi_part_on_device', autospec=True)
-    @mock.patch.object(os, 'makedirs', autospec=True)
-    def test__manage_uefi_nvme_device(self, mkdir_mock, mock_utils_efi_part,
+    def test__manage_uefi_nvme_device(self, mock_utils_efi_part,
                                       mock_get_part_uuid, mock_efi_bl,
                                       mock_execute, mock_dispatch):
         mock_utils_efi_part.return_value = '1'
@@ -2120,31 +2102,27 @@ efibootmgr: ** Warning ** : Boot0005 has same label ironic1\n
         expected = [mock.call('partx', '-u', '/dev/fakenvme0', attempts=3,
                               delay_on_retry=True),
                     mock.call('udevadm', 'settle'),
-                    mock.call('mount', '/dev/fakenvme0p1',
-                              self.fake_dir + '/boot/efi'),
-                    mock.call('efibootmgr'),
-                    mock.call('efibootmgr', '-c', '-d', '/dev/fakenvme0',
-                              '-p', '1', '-w',
-                              '-L', 'ironic1', '-l',
-                              '\\EFI\\BOOT\\BOOTX64.EFI'),
-                    mock.call('umount', self.fake_dir + '/boot/efi',
-                              attempts=3, delay_on_retry=True),
-                    mock.call('sync')]
+                    mock.call('mount', '-o', 'ro', '/dev/fakenvme0p1',
+                              self.fake_dir),
+                    mock.call('efibootmgr', '-v'),
+                    mock.call('sh', '-e', '-c',
+                              'efibootmgr -c -d /dev/fakenvme0 -p 1 -w '
+                              '-L ironic1 '
+                              "-l '\\EFI\\BOOT\\BOOTX64.EFI'"),
+                    mock.call('umount', self.fake_dir,
+                              attempts=3, delay_on_retry=True)]
 
         result = image._manage_uefi('/dev/fakenvme0', self.fake_root_uuid)
         self.assertTrue(result)
-        mkdir_mock.assert_called_once_with(self.fake_dir + '/boot/efi')
-        mock_efi_bl.assert_called_once_with(self.fake_dir + '/boot/efi')
+        mock_efi_bl.assert_called_once_with(self.fake_dir)
         mock_execute.assert_has_calls(expected)
-        self.assertEqual(7, mock_execute.call_count)
+        self.assertEqual(6, mock_execute.call_count)
 
-    @mock.patch.object(os.path, 'exists', lambda *_: False)
     @mock.patch.object(image, '_get_efi_bootloaders', autospec=True)
     @mock.patch.object(image, '_get_partition', autospec=True)
     @mock.patch.object(utils, 'get_efi_part_on_device', autospec=True)
-    @mock.patch.object(os, 'makedirs', autospec=True)
     def test__manage_uefi_wholedisk(
-            self, mkdir_mock, mock_utils_efi_part,
+            self, mock_utils_efi_part,
             mock_get_part_uuid, mock_efi_bl, mock_execute,
             mock_dispatch):
         mock_utils_efi_part.return_value = '1'
@@ -2160,100 +2138,172 @@ efibootmgr: ** Warning ** : Boot0005 has same label ironic1\n
         expected = [mock.call('partx', '-u', '/dev/fake', attempts=3,
                               delay_on_retry=True),
                     mock.call('udevadm', 'settle'),
-                    mock.call('mount', self.fake_efi_system_part,
-                              self.fake_dir + '/boot/efi'),
-                    mock.call('efibootmgr'),
-                    mock.call('efibootmgr', '-c', '-d', self.fake_dev,
-                              '-p', '1', '-w',
-                              '-L', 'ironic1', '-l',
-                              '\\EFI\\BOOT\\BOOTX64.EFI'),
-                    mock.call('umount', self.fake_dir + '/boot/efi',
-                              attempts=3, delay_on_retry=True),
-                    mock.call('sync')]
+                    mock.call('mount', '-o', 'ro', self.fake_efi_system_part,
+                              self.fake_dir),
+                    mock.call('efibootmgr', '-v'),
+                    mock.call('sh', '-e', '-c',
+                              'efibootmgr -c -d /dev/fake -p 1 -w -L ironic1 '
+                              "-l '\\EFI\\BOOT\\BOOTX64.EFI'"),
+                    mock.call('umount', self.fake_dir,
+                              attempts=3, delay_on_retry=True)]
 
         result = image._manage_uefi(self.fake_dev, None)
         self.assertTrue(result)
-        mkdir_mock.assert_called_once_with(self.fake_dir + '/boot/efi')
-        mock_efi_bl.assert_called_once_with(self.fake_dir + '/boot/efi')
+        mock_efi_bl.assert_called_once_with(self.fake_dir)
         mock_execute.assert_has_calls(expected)
-        self.assertEqual(7, mock_execute.call_count)
+        self.assertEqual(6, mock_execute.call_count)
 
-    @mock.patch.object(os, 'walk', autospec=True)
-    @mock.patch.object(os, 'access', autospec=False)
-    def test__no_efi_bootloaders(self, mock_access, mock_walk, mock_execute,
-                                 mock_dispatch):
-        # No valid efi file.
-        mock_walk.return_value = [
-            ('/boot/efi', ['EFI'], []),
-            ('/boot/efi/EFI', ['centos', 'BOOT'], []),
-            ('/boot/efi/EFI/centos', ['fw', 'fonts'],
-             ['shimx64-centos.efi', 'BOOT.CSV', 'BOOTX64.CSV',
-              'MokManager.efi', 'mmx64.efi', 'shim.efi', 'fwupia32.efi',
-              'fwupx64.efi', 'shimx64.efi', 'grubenv', 'grubx64.efi',
-              'grub.cfg']),
-            ('/boot/efi/EFI/centos/fw', [], []),
-            ('/boot/efi/EFI/centos/fonts', [], ['unicode.pf2']),
-            ('/boot/efi/EFI/BOOT', [], [])
-        ]
+    @mock.patch.object(time, 'monotonic', autospec=True)
+    def test__rescan_device_skips_recent_rescan(self, mock_monotonic,
+                                                mock_execute, mock_dispatch):
+        image._LAST_RESCAN[self.fake_dev] = 100
+        mock_monotonic.return_value = 102
 
-        result = image._get_efi_bootloaders("/boot/efi")
-        self.assertEqual(result, [])
-        mock_access.assert_not_called()
+        image._rescan_device(self.fake_dev, force=False)
+        mock_execute.assert_not_called()
+        self.assertEqual(100, image._LAST_RESCAN[self.fake_dev])
 
-    @mock.patch.object(os, 'walk', autospec=True)
-    @mock.patch.object(os, 'access', autospec=True)
-    def test__get_efi_bootloaders(self, mock_access, mock_walk, mock_execute,
-                                  mock_dispatch):
-        mock_walk.return_value = [
-            ('/boot/efi', ['EFI'], []),
-            ('/boot/efi/EFI', ['centos', 'BOOT'], []),
-            ('/boot/efi/EFI/centos', ['fw', 'fonts'],
-             ['shimx64-centos.efi', 'BOOT.CSV', 'BOOTX64.CSV',
-              'MokManager.efi', 'mmx64.efi', 'shim.efi', 'fwupia32.efi',
-              'fwupx64.efi', 'shimx64.efi', 'grubenv', 'grubx64.efi',
-              'grub.cfg']),
-            ('/boot/efi/EFI/centos/fw', [], []),
-            ('/boot/efi/EFI/centos/fonts', [], ['unicode.pf2']),
-            ('/boot/efi/EFI/BOOT', [],
-             ['BOOTX64.EFI', 'fallback.efi', 'fbx64.efi'])
-        ]
-        mock_access.return_value = True
-        result = image._get_efi_bootloaders("/boot/efi")
-        self.assertEqual(result[0], 'EFI/BOOT/BOOTX64.EFI')
+    @mock.patch.object(time, 'monotonic', autospec=True)
+    def test__rescan_device_outdated_rescan(self, mock_monotonic,
+                                            mock_execute, mock_dispatch):
+        image._LAST_RESCAN[self.fake_dev] = 100
+        mock_monotonic.return_value = 110
+
+        image._rescan_device(self.fake_dev, force=False)
+        mock_execute.assert_has_calls([
+            mock.call('partx', '-u', self.fake_dev, attempts=3,
+                      delay_on_retry=True),
+            mock.call('udevadm', 'settle')])
+        self.assertEqual(110, image._LAST_RESCAN[self.fake_dev])
+
+    @mock.patch.object(time, 'monotonic', autospec=True)
+    def test__rescan_device_forced(self, mock_monotonic, mock_execute,
+                                   mock_dispatch):
+        image._LAST_RESCAN[self.fake_dev] = 100
+        mock_monotonic.return_value = 101
 
-    @mock.patch.object(os, 'walk', autospec=True)
-    @mock.patch.object(os, 'access', autospec=True)
-    def test__get_windows_efi_bootloaders(self, mock_access, mock_walk,
-                                          mock_execute, mock_dispatch):
-        mock_walk.return_value = [
-            ('/boot/efi', ['WINDOWS'], []),
-            ('/boot/efi/WINDOWS', ['system32'], []),
-            ('/boot/efi/WINDOWS/system32', [],
-             ['winload.efi'])
-        ]
-        mock_access.return_value = True
-        result = image._get_efi_bootloaders("/boot/efi")
-        self.assertEqual(result[0], 'WINDOWS/system32/winload.efi')
+        image._rescan_device(self.fake_dev)
+        self.assertEqual(2, mock_execute.call_count)
+        self.assertEqual(101, image._LAST_RESCAN[self.fake_dev])
+
+    def test__rescan_device_failure_not_recorded(self, mock_execute,
+                                                 mock_dispatch):
+        mock_execute.side_effect = [processutils.ProcessExecutionError,
+                                    ('', ''), ('', '')]
+
+        image._rescan_device(self.fake_dev)
+        self.assertNotIn(self.fake_dev, image._LAST_RESCAN)
+        image._rescan_device(self.fake_dev, force=False)
+        self.assertIn(self.fake_dev, image._LAST_RESCAN)
+        self.assertEqual(3, mock_execute.call_count)
+
+    @mock.patch.object(image, '_get_efi_bootloaders', autospec=True)
+    @mock.patch.object(utils, 'get_efi_part_on_device', autospec=True)
+    def test__manage_uefi_rescans_after_recent_rescan(
+            self, mock_utils_efi_part, mock_efi_bl, mock_execute,
+            mock_dispatch):
+        # The partition table may have been rewritten since, e.g. by standby.
+        image._LAST_RESCAN[self.fake_dev] = time.monotonic()
+        mock_utils_efi_part.return_value = 1
+        mock_efi_bl.return_value = []
+        mock_execute.return_value = ('', '')
+
+        result = image._manage_uefi(self.fake_dev)
+        self.assertFalse(result)
+        mock_execute.assert_has_calls([
+            mock.call('partx', '-u', self.fake_dev, attempts=3,
+                      delay_on_retry=True),
+            mock.call('udevadm', 'settle'),
+            mock.call('mount', '-o', 'ro', self.fake_efi_system_part,
+                      self.fake_dir)])
+
+    @mock.patch.object(image, '_get_efi_bootloaders', autospec=True)
+    @mock.patch.object(utils, 'get_efi_part_on_device', autospec=True)
+    def test__manage_uefi_rescans_once(self, mock_utils_efi_part,
+                                       mock_efi_bl, mock_execute,
+                                       mock_dispatch):
+        mock_utils_efi_part.return_value = None
+        mock_efi_bl.return_value = []
+        mock_execute.side_effect = [
+            ('', ''), ('', ''),
+            ('KNAME="fake" UUID="" PARTUUID="" TYPE="disk" LABEL=""\n'
+             'KNAME="fake1" UUID="%s" PARTUUID="" TYPE="part" LABEL=""'
+             % self.fake_efi_system_part_uuid, ''),
+            ('', ''), ('', '')]
+
+        result = image._manage_uefi(self.fake_dev,
+                                    self.fake_efi_system_part_uuid)
+        self.assertFalse(result)
+        mock_execute.assert_has_calls([
+            mock.call('partx', '-u', self.fake_dev, attempts=3,
+                      delay_on_retry=True),
+            mock.call('udevadm', 'settle'),
+            mock.call('lsblk', '-PbioKNAME,UUID,PARTUUID,TYPE,LABEL',
+                      self.fake_dev),
+            mock.call('mount', '-o', 'ro', self.fake_efi_system_part,
+                      self.fake_dir),
+            mock.call('umount', self.fake_dir, attempts=3,
+                      delay_on_retry=True)])
+        self.assertEqual(5, mock_execute.call_count)
+
+    @mock.patch.object(image, '_get_partition', autospec=True)
+    @mock.patch.object(utils, 'get_efi_part_on_device', autospec=True)
+    def test__get_efi_partition_by_uuid(self, mock_utils_efi_part,
+                                        mock_get_part_uuid, mock_execute,
+                                        mock_dispatch):
+        mock_utils_efi_part.return_value = None
+        for dev, part, expected in [('/dev/sda', '/dev/sda12', 12),
+                                    ('/dev/nvme0n1', '/dev/nvme0n1p3', 3),
+                                    ('/dev/md0', '/dev/md0p1', 1),
+                                    ('/dev/sda', '/dev/sdb1', None),
+                                    ('/dev/sda', '/dev/sda', None)]:
+            mock_get_part_uuid.return_value = part
+            self.assertEqual(expected, image._get_efi_partition(
+                dev, self.fake_efi_system_part_uuid))
 
     def test__run_efibootmgr_no_bootloaders(self, mock_execute, mock_dispatch):
+        mock_execute.return_value = ('', '')
         result = image._run_efibootmgr([], self.fake_dev,
                                        self.fake_efi_system_part)
-        expected = []
         self.assertIsNone(result)
-        mock_execute.assert_has_calls(expected)
+        mock_execute.assert_called_once_with('efibootmgr', '-v')
 
     def test__run_efibootmgr(self, mock_execute, mock_dispatch):
+        mock_execute.return_value = ('', '')
         result = image._run_efibootmgr(['EFI/BOOT/BOOTX64.EFI'],
                                        self.fake_dev,
                                        self.fake_efi_system_part)
-        expected = [mock.call('efibootmgr'),
-                    mock.call('efibootmgr', '-c', '-d', self.fake_dev,
-                              '-p', self.fake_efi_system_part, '-w',
-                              '-L', 'ironic1', '-l',
-                              '\\EFI\\BOOT\\BOOTX64.EFI')]
+        expected = [mock.call('efibootmgr', '-v'),
+                    mock.call('sh', '-e', '-c',
+                              'efibootmgr -c -d /dev/fake -p /dev/fake1 -w '
+                              '-L ironic1 '
+                              "-l '\\EFI\\BOOT\\BOOTX64.EFI'")]
         self.assertIsNone(result)
         mock_execute.assert_has_calls(expected)
 
+    def test__run_efibootmgr_removes_duplicates_first(self, mock_execute,
+                                                      mock_dispatch):
+        efibootmgr_output = (
+            'BootCurrent: 0001\n'
+            'BootOrder: 0000,0001,0002,0003\n'
+            'Boot0000* ironic1\tHD(1,GPT,...)/File(\\EFI\\BOOT\\BOOTX64.EFI)\n'
+            'Boot0001* Network\tPciRoot(0x0)/Pci(0x1,0x1)\n'
+            'Boot0002* ironic2\tHD(1,GPT,...)/File(\\EFI\\winload.efi)\n'
+            'Boot0003* ironic10\tHD(1,GPT,...)/File(\\EFI\\grubaa64.efi)\n')
+        mock_execute.side_effect = [(efibootmgr_output, '')] + [('', '')] * 4
+        image._run_efibootmgr(['EFI/BOOT/BOOTX64.EFI',
+                               'WINDOWS/system32/winload.efi'],
+                              self.fake_dev, '1')
+        expected = [mock.call('efibootmgr', '-v'),
+                    mock.call('sh', '-e', '-c',
+                              'efibootmgr -b 0000 -B\n'
+                              'efibootmgr -b 0002 -B\n'
+                              'efibootmgr -c -d /dev/fake -p 1 -w -L ironic1 '
+                              "-l '\\EFI\\BOOT\\BOOTX64.EFI'\n"
+                              'efibootmgr -c -d /dev/fake -p 1 -w -L ironic2 '
+                              "-l '\\WINDOWS\\system32\\winload.efi'")]
+        self.assertEqual(expected, mock_execute.call_args_list)
+
     @mock.patch.object(os.path, 'exists', lambda *_: True)
     def test__append_uefi_to_fstab_handles_error(self, mock_execute,
                                                  mock_dispatch):
@@ -2261,3 +2311,109 @@ efibootmgr: ** Warning ** : Boot0005 has same label ironic1\n
             mock_open.side_effect = OSError('boom')
             image._append_uefi_to_fstab(
                 self.fake_dir, 'abcd-efgh')
+
+
+class TestGetEfiBootloaders(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestGetEfiBootloaders, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.tempdir))
+
+    def _create_files(self, files, mode=0o755):
+        for name in files:
+            path = os.path.join(self.tempdir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+            os.chmod(path, mode)
+
+    def _create_centos_tree(self):
+        os.makedirs(os.path.join(self.tempdir, 'EFI/centos/fw'))
+        os.makedirs(os.path.join(self.tempdir, 'EFI/BOOT'))
+        self._create_files(
+            'EFI/centos/%s' % name
+            for name in ['shimx64-centos.efi', 'BOOT.CSV', 'BOOTX64.CSV',
+                         'MokManager.efi', 'mmx64.efi', 'shim.efi',
+                         'fwupia32.efi', 'fwupx64.efi', 'shimx64.efi',
+                         'grubenv', 'grubx64.efi', 'grub.cfg'])
+        self._create_files(['EFI/centos/fonts/unicode.pf2'])
+
+    @mock.patch.object(os, 'access', autospec=True)
+    def test__no_efi_bootloaders(self, mock_access):
+        # No valid efi file.
+        self._create_centos_tree()
+
+        result = image._get_efi_bootloaders(self.tempdir)
+        self.assertEqual(result, [])
+        mock_access.assert_not_called()
+
+    def test__get_efi_bootloaders(self):
+        self._create_centos_tree()
+        self._create_files(['EFI/BOOT/BOOTX64.EFI', 'EFI/BOOT/fallback.efi',
+                            'EFI/BOOT/fbx64.efi'])
+
+        result = image._get_efi_bootloaders(self.tempdir)
+        self.assertEqual(['EFI/BOOT/BOOTX64.EFI'], result)
+
+    def test__get_windows_efi_bootloaders(self):
+        self._create_files(['WINDOWS/system32/winload.efi'])
+
+        result = image._get_efi_bootloaders(self.tempdir)
+        self.assertEqual(['WINDOWS/system32/winload.efi'], result)
+
+    def test__get_efi_bootloaders_walk_order(self):
+        self._create_files(['EFI/B/bootaa64.efi', 'EFI/A/bootx64.efi',
+                            'EFI/A/grubaa64.efi', 'EFI/A/sub/bootia32.efi',
+                            'EFI/C/bootarm.efi', 'bootriscv64.efi'])
+        # The bootloaders must be returned in the order os.walk visits them,
+        # whatever the order of the directory listings is.
+        expected = []
+        for root, dirs, files in os.walk(self.tempdir):
+            expected.extend(os.path.relpath(os.path.join(root, name),
+                                            self.tempdir)
+                            for name in files)
+
+        result = image._get_efi_bootloaders(self.tempdir)
+        self.assertEqual(expected, result)
+
+    def test__get_efi_bootloaders_unreadable_directory(self):
+        self._create_files(['EFI/BOOT/BOOTX64.EFI', 'EFI/bad/grubaa64.efi'])
+        bad = os.fsencode(os.path.join(self.tempdir, 'EFI/bad'))
+        real_scandir = os.scandir
+
+        def fake_scandir(path):
+            if path == bad:
+                raise OSError(errno.EIO, 'Input/output error')
+            return real_scandir(path)
+
+        with mock.patch.object(os, 'scandir', autospec=True,
+                               side_effect=fake_scandir):
+            result = image._get_efi_bootloaders(self.tempdir)
+        self.assertEqual(['EFI/BOOT/BOOTX64.EFI'], result)
+
+    def test__get_efi_bootloaders_location_in_path(self):
+        # The location itself appears within the path of the bootloader.
+        nested = os.path.join(self.tempdir.lstrip('/'), 'BOOTX64.EFI')
+        self._create_files([nested])
+
+        result = image._get_efi_bootloaders(self.tempdir)
+        self.assertEqual([nested], result)
+
+    def test__get_efi_bootloaders_non_ascii_path(self):
+        self._create_files(['EFI/debian-\u00e9/grubaa64.efi',
+                            'EFI/debian-\u00e9/\u00e9.efi'])
+
+        result = image._get_efi_bootloaders(self.tempdir)
+        self.assertEqual(['EFI/debian-\u00e9/grubaa64.efi'], result)
+
+    def test__get_efi_bootloaders_not_executable(self):
+        self._create_files(['EFI/BOOT/BOOTX64.EFI'], mode=0o644)
+
+        result = image._get_efi_bootloaders(self.tempdir)
+        self.assertEqual([], result)
+
+    def test__get_efi_bootloaders_ignores_directories(self):
+        os.makedirs(os.path.join(self.tempdir, 'EFI/BOOT/BOOTX64.EFI'))
+
+        result = image._get_efi_bootloaders(self.tempdir)
+        self.assertEqual([], result)